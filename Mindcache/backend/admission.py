@@ -0,0 +1,166 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+# Admission configuration
+MAX_ANALYSIS_IN_FLIGHT = 4  # concurrent NLP analyses
+MAX_STORAGE_IN_FLIGHT = 8  # concurrent database writes
+STORAGE_WAIT_TIMEOUT = 0.5  # seconds to wait for a storage slot
+CLIENT_RATE = 5.0  # analyses per second per client
+CLIENT_BURST = 20  # bucket capacity per client
+MAX_TRACKED_CLIENTS = 1024
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at rate tokens per second"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_consume(self, tokens: float = 1.0) -> bool:
+        self._refill(time.monotonic())
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+
+class Slot:
+    """Context manager that releases an acquired admission slot"""
+
+    def __init__(self, release):
+        self._release = release
+
+    def __enter__(self):
+        return self
+
+    def release(self):
+        self._release()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
+        return False
+
+
+class AdmissionController:
+    """Bounded in-flight limits and per-client rate limits for ingest.
+
+    Analysis work is admitted without waiting: if no analysis slot is free or
+    the client is over its rate, the caller should store the interaction and
+    skip analysis. Storage waits briefly for a slot and reports saturation
+    when none frees up, which callers surface as 429.
+    """
+
+    def __init__(self, max_analysis: int = MAX_ANALYSIS_IN_FLIGHT,
+                 max_storage: int = MAX_STORAGE_IN_FLIGHT,
+                 storage_timeout: float = STORAGE_WAIT_TIMEOUT,
+                 client_rate: float = CLIENT_RATE, client_burst: float = CLIENT_BURST):
+        self.max_analysis = max_analysis
+        self.max_storage = max_storage
+        self.storage_timeout = storage_timeout
+        self.client_rate = client_rate
+        self.client_burst = client_burst
+
+        self._analysis_slots = threading.BoundedSemaphore(max_analysis)
+        self._storage_slots = threading.BoundedSemaphore(max_storage)
+        self._lock = threading.Lock()
+        self._buckets: 'OrderedDict[str, TokenBucket]' = OrderedDict()
+
+        self.analysis_in_flight = 0
+        self.storage_in_flight = 0
+        self.storage_waiting = 0
+        self.counters = {
+            'admitted': 0,
+            'shed_rate_limited': 0,
+            'shed_busy': 0,
+            'rejected_storage': 0,
+        }
+
+    def _count(self, name: str):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _bucket(self, client_id: str) -> TokenBucket:
+        """Return the client's bucket, kept in least-recently-used order"""
+        bucket = self._buckets.get(client_id)
+        if bucket is None:
+            if len(self._buckets) >= MAX_TRACKED_CLIENTS:
+                # Forget the least recently seen client; a fresh bucket starts full
+                self._buckets.popitem(last=False)
+            bucket = TokenBucket(self.client_rate, self.client_burst)
+            self._buckets[client_id] = bucket
+        else:
+            self._buckets.move_to_end(client_id)
+        return bucket
+
+    def try_analysis(self, client_id: Optional[str]):
+        """Return a Slot if analysis may run now, else None (store-only).
+
+        A token is only spent once a slot is granted, so requests shed as busy
+        do not drain the client's rate. client_id None skips the rate limit.
+        """
+        if not self._analysis_slots.acquire(blocking=False):
+            self._count('shed_busy')
+            return None
+
+        with self._lock:
+            if client_id is not None and not self._bucket(client_id).try_consume():
+                self.counters['shed_rate_limited'] += 1
+                limited = True
+            else:
+                self.analysis_in_flight += 1
+                self.counters['admitted'] += 1
+                limited = False
+        if limited:
+            self._analysis_slots.release()
+            return None
+        return Slot(self._release_analysis)
+
+    def _release_analysis(self):
+        with self._lock:
+            self.analysis_in_flight -= 1
+        self._analysis_slots.release()
+
+    def acquire_storage(self):
+        """Return a Slot once a storage slot is free, or None if saturated"""
+        with self._lock:
+            self.storage_waiting += 1
+        acquired = self._storage_slots.acquire(timeout=self.storage_timeout)
+        with self._lock:
+            self.storage_waiting -= 1
+            if acquired:
+                self.storage_in_flight += 1
+            else:
+                self.counters['rejected_storage'] += 1
+        if not acquired:
+            return None
+        return Slot(self._release_storage)
+
+    def _release_storage(self):
+        with self._lock:
+            self.storage_in_flight -= 1
+        self._storage_slots.release()
+
+    def retry_after(self) -> int:
+        """Seconds a rejected client should wait before retrying"""
+        return max(1, int(round(self.storage_timeout * 2)))
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'analysis_in_flight': self.analysis_in_flight,
+                'analysis_limit': self.max_analysis,
+                'storage_in_flight': self.storage_in_flight,
+                'storage_waiting': self.storage_waiting,
+                'storage_limit': self.max_storage,
+                'tracked_clients': len(self._buckets),
+                **self.counters,
+            }
@@ -10,6 +10,21 @@ import nltk
 from textblob import TextBlob
 from collections import Counter
 import logging
+import gzip
+import zlib
+import math
+import time
+import os
+import atexit
+import threading
+from related_index import RelatedPagesIndex
+from admission import AdmissionController
+from ingest_log import IngestLog, IngestLogError
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -19,10 +34,132 @@ CORS(app)
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Wire encoding configuration
+MSGPACK_CONTENT_TYPES = ('application/msgpack', 'application/x-msgpack')
+MAX_DECOMPRESSED_SIZE = 10 * 1024 * 1024  # bytes
+MIN_COMPRESS_SIZE = 512  # bytes; /api/analytics payloads are ~0.8-1 KB
+
+# Related-pages index configuration
+RELATED_INDEX_DIR = "related_index"
+RELATED_USE_IVF = False  # enable the coarse index for large corpora
+RELATED_MAX_RESULTS = 50
+
+ANALYZABLE_ACTIONS = ('reading_session', 'page_session')
+PENDING_BATCH_SIZE = 50
+
+# Durable ingest: acknowledge after an fsynced log append, load into SQLite in the background
+DURABLE_INGEST = False
+INGEST_LOG_DIR = "ingest_log"
+
+INSERT_INTERACTION_SQL = '''
+    INSERT INTO interactions 
+    (session_id, action_type, url, title, content_summary, interaction_data, timestamp,
+     processed, analysis_deferred)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+class PayloadError(ValueError):
+    """Raised when a request body cannot be decoded"""
+
+def decompress_body(body: bytes, content_encoding: str) -> bytes:
+    """Undo gzip/deflate Content-Encoding, capped at MAX_DECOMPRESSED_SIZE"""
+    encoding = (content_encoding or '').strip().lower()
+    if encoding in ('', 'identity'):
+        return body
+    if encoding in ('gzip', 'x-gzip'):
+        wbits = 16 + zlib.MAX_WBITS
+    elif encoding == 'deflate':
+        # Accept zlib-wrapped as well as raw deflate streams
+        wbits = zlib.MAX_WBITS if body[:1] == b'\x78' else -zlib.MAX_WBITS
+    else:
+        raise PayloadError(f"Unsupported Content-Encoding: {content_encoding}")
+    
+    try:
+        decompressor = zlib.decompressobj(wbits)
+        data = decompressor.decompress(body, MAX_DECOMPRESSED_SIZE)
+        if decompressor.unconsumed_tail:
+            raise PayloadError("Decompressed body too large")
+        return data + decompressor.flush()
+    except zlib.error as e:
+        raise PayloadError(f"Invalid {encoding} body: {str(e)}")
+
+def reject_constant(name: str):
+    """json.loads parse_constant hook; SQLite's JSON functions reject NaN and Infinity"""
+    raise ValueError(f"{name} is not allowed")
+
+def decode_request_payload():
+    """Decode the current request body into (data, raw_json).
+    
+    Supports JSON and MessagePack bodies, optionally gzip/deflate compressed.
+    raw_json is the decoded JSON text when the body was JSON, so callers can
+    store it as-is instead of serializing the parsed object again.
+    """
+    body = decompress_body(request.get_data(cache=False), request.headers.get('Content-Encoding', ''))
+    if not body:
+        return None, None
+    
+    if request.mimetype in MSGPACK_CONTENT_TYPES:
+        if msgpack is None:
+            raise PayloadError("MessagePack support requires the msgpack package")
+        try:
+            return msgpack.unpackb(body, raw=False), None
+        except Exception as e:
+            raise PayloadError(f"Invalid MessagePack body: {str(e)}")
+    
+    try:
+        raw_json = body.decode('utf-8')
+        return json.loads(raw_json, parse_constant=reject_constant), raw_json
+    except (UnicodeDecodeError, ValueError) as e:
+        raise PayloadError(f"Invalid JSON body: {str(e)}")
+
+INTERACTION_COLUMNS = ('session_id', 'action_type', 'url', 'title', 'content_summary',
+                       'interaction_data', 'timestamp', 'processed', 'analysis_deferred')
+
+def check_interaction_row(row: tuple):
+    """Reject values SQLite cannot bind before they reach the database or ingest log"""
+    for column, value in zip(INTERACTION_COLUMNS, row):
+        if value is None or isinstance(value, (str, datetime)):
+            continue
+        if isinstance(value, float) and math.isfinite(value):
+            continue
+        if isinstance(value, int) and -2**63 <= value < 2**63:
+            continue
+        raise PayloadError(f"Field '{column}' must be a string, finite number or null")
+
+def as_json_text(value):
+    """Return value as JSON text for a TEXT column, passing strings through"""
+    if value is None or isinstance(value, str):
+        return value
+    return to_json_text(value)
+
+def to_json_text(value) -> str:
+    """json.dumps() that reports NaN/Infinity (e.g. from MessagePack) as bad input"""
+    try:
+        return json.dumps(value, allow_nan=False)
+    except ValueError as e:
+        raise PayloadError(str(e))
+
+def compressed_jsonify(payload):
+    """jsonify() that gzips large responses when the client accepts it"""
+    response = jsonify(payload)
+    response.vary.add('Accept-Encoding')
+    
+    if request.accept_encodings['gzip'] <= 0 or response.content_length is None:
+        return response
+    if response.content_length < MIN_COMPRESS_SIZE:
+        return response
+    
+    response.set_data(gzip.compress(response.get_data(), compresslevel=6))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
 class MindCacheAnalyzer:
-    def __init__(self, db_path: str = "mindcache.db"):
+    def __init__(self, db_path: str = "mindcache.db", related_index_dir: str = RELATED_INDEX_DIR):
         self.db_path = db_path
         self.init_database()
+        self.related_index = RelatedPagesIndex(related_index_dir, use_ivf=RELATED_USE_IVF)
+        self.ingest_log = None
+        self._ingest_log_lock = threading.Lock()
         
     def init_database(self):
         conn = sqlite3.connect(self.db_path)
@@ -38,10 +175,22 @@ class MindCacheAnalyzer:
                 content_summary TEXT,
                 interaction_data TEXT,
                 timestamp DATETIME,
-                processed BOOLEAN DEFAULT FALSE
+                processed BOOLEAN DEFAULT FALSE,
+                analysis_deferred BOOLEAN DEFAULT FALSE
             )
         ''')
         
+        # Databases created before load shedding lack the deferred marker
+        try:
+            cursor.execute('ALTER TABLE interactions ADD COLUMN analysis_deferred BOOLEAN DEFAULT FALSE')
+        except sqlite3.OperationalError:
+            pass
+        
+        cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_interactions_deferred
+            ON interactions (id) WHERE analysis_deferred = 1
+        ''')
+        
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS content_analysis (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -121,6 +270,8 @@ class MindCacheAnalyzer:
                 'summary': self.generate_summary(text, title)
             }
             
+            self.index_related_content(content_data.get('url', ''), title, text)
+            
             return analysis
             
         except Exception as e:
@@ -133,6 +284,15 @@ class MindCacheAnalyzer:
                 }
             }
     
+    def index_related_content(self, url: str, title: str, text: str):
+        """Add analyzed page text to the related-pages index"""
+        if not url:
+            return
+        try:
+            self.related_index.add(url, title, f"{title} {text}")
+        except Exception as e:
+            logger.error(f"Related index error: {str(e)}")
+    
     def analyze_reading_behavior(self, interaction_data: Dict) -> Dict:
         """Analyze user reading behavior patterns"""
         try:
@@ -324,49 +484,142 @@ class MindCacheAnalyzer:
         summary = ". ".join([s for s in summary_sentences if s])
         return summary[:300] + "..." if len(summary) > 300 else summary
     
-    def store_interaction(self, interaction_data: Dict) -> bool:
-        """Store interaction data in database"""
+    def store_interaction(self, interaction_data: Dict, raw_json: str = None,
+                          processed: bool = False, deferred: bool = False) -> bool:
+        """Store interaction data in database.
+        
+        raw_json, when given, is the original request text for interaction_data
+        and is stored directly instead of being serialized again. Rows stored
+        with deferred=True were shed under load and are picked up later by
+        process_pending_interactions.
+        """
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
             # Generate session ID based on user agent and timestamp
             session_id = hashlib.md5(
                 f"{interaction_data.get('userAgent', '')}{datetime.now().date()}".encode()
             ).hexdigest()[:16]
             
-            cursor.execute('''
-                INSERT INTO interactions 
-                (session_id, action_type, url, title, content_summary, interaction_data, timestamp)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (
+            self.write_interaction((
                 session_id,
                 interaction_data.get('action', ''),
                 interaction_data.get('url', ''),
                 interaction_data.get('title', ''),
-                json.dumps(interaction_data.get('contentSummary', {})),
-                json.dumps(interaction_data),
-                datetime.now()
+                to_json_text(interaction_data.get('contentSummary', {})),
+                raw_json if raw_json is not None else to_json_text(interaction_data),
+                datetime.now(),
+                processed,
+                deferred
             ))
-            
-            conn.commit()
-            conn.close()
             return True
             
+        except (PayloadError, IngestLogError):
+            # Bad input and an unusable ingest log are reported by the endpoint
+            raise
         except Exception as e:
             logger.error(f"Database storage error: {str(e)}")
             return False
 
+    def start_ingest_log(self) -> IngestLog:
+        """Open the durable ingest log, replaying segments left by a previous run"""
+        with self._ingest_log_lock:
+            if self.ingest_log is None:
+                ingest_log = IngestLog(INGEST_LOG_DIR, self.db_path, self.apply_interaction_rows)
+                ingest_log.start()
+                atexit.register(ingest_log.close)
+                self.ingest_log = ingest_log
+            return self.ingest_log
+    
+    def apply_interaction_rows(self, cursor: sqlite3.Cursor, rows: List):
+        """Insert interaction rows loaded from the ingest log"""
+        cursor.executemany(INSERT_INTERACTION_SQL, rows)
+    
+    def write_interaction(self, row: tuple):
+        """Insert one interactions row, or log it when DURABLE_INGEST is on.
+        
+        Returns the new row id, or None when the row was logged and will be
+        loaded into the database in the background. Raises PayloadError for
+        values SQLite cannot store.
+        """
+        check_interaction_row(row)
+        if DURABLE_INGEST:
+            # Stored as text either way; sqlite3 adapts datetime the same as str()
+            record = [str(value) if isinstance(value, datetime) else value for value in row]
+            self.start_ingest_log().append(record)
+            return None
+        
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute(INSERT_INTERACTION_SQL, row)
+        conn.commit()
+        conn.close()
+        return cursor.lastrowid
+    
+    def process_pending_interactions(self, limit: int = PENDING_BATCH_SIZE) -> int:
+        """Analyze interactions that analyze_interaction deferred under load"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            SELECT id, interaction_data FROM interactions
+            WHERE analysis_deferred = 1
+            ORDER BY id
+            LIMIT ?
+        ''', (limit,))
+        pending = cursor.fetchall()
+        conn.close()
+        
+        # Analyze with no transaction open so stores are not blocked meanwhile
+        for row_id, interaction_json in pending:
+            try:
+                self.analyze_content(json.loads(interaction_json or '{}'))
+            except ValueError as e:
+                logger.error(f"Skipping unreadable interaction {row_id}: {str(e)}")
+        
+        if pending:
+            ids = [row_id for row_id, _ in pending]
+            conn = sqlite3.connect(self.db_path)
+            conn.execute(
+                f"UPDATE interactions SET processed = 1, analysis_deferred = 0 "
+                f"WHERE id IN ({','.join('?' * len(ids))})", ids)
+            conn.commit()
+            conn.close()
+        return len(pending)
+    
+    def count_pending_interactions(self) -> int:
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT COUNT(*) FROM interactions WHERE analysis_deferred = 1')
+        count = cursor.fetchone()[0]
+        conn.close()
+        return count
+
 # Initialize analyzer
 analyzer = MindCacheAnalyzer()
+admission = AdmissionController()
+
+def client_id() -> str:
+    """Identify the caller for per-client rate limits.
+    
+    Uses the connection address only; a client-supplied header would let
+    callers mint a fresh bucket per request.
+    """
+    return request.remote_addr or 'unknown'
+
+def too_many_requests(message: str):
+    response = jsonify({"error": message})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(admission.retry_after())
+    return response
 
 @app.route('/api/analyze', methods=['POST'])
 def analyze_interaction():
    
     try:
-        data = request.get_json()
+        try:
+            data, raw_json = decode_request_payload()
+        except PayloadError as e:
+            return jsonify({"error": str(e)}), 400
         
-        if not data:
+        if not isinstance(data, dict) or not data:
             return jsonify({"error": "No data provided"}), 400
         
         # logger.info(f"Received action: {data.get('action')}")
@@ -376,18 +629,37 @@ def analyze_interaction():
         if 'readingAnalysis' in data:
             logger.info(f"Reading analysis keys: {list(data['readingAnalysis'].keys())}")
         
-        # Store the interaction
-        stored = analyzer.store_interaction(data)
+        # Only reject when storage itself is saturated
+        storage_slot = admission.acquire_storage()
+        if storage_slot is None:
+            return too_many_requests("Storage is saturated, retry later")
+        
+        # Under pressure, store without analysis and leave the row unprocessed
+        analysis_slot = None
+        analyzable = data.get('action') in ANALYZABLE_ACTIONS
+        with storage_slot:
+            if analyzable:
+                analysis_slot = admission.try_analysis(client_id())
+            try:
+                stored = analyzer.store_interaction(
+                    data, raw_json,
+                    processed=analysis_slot is not None,
+                    deferred=analyzable and analysis_slot is None
+                )
+            except Exception:
+                if analysis_slot is not None:
+                    analysis_slot.release()
+                raise
         
-        # Perform analysis
         result = {
             "stored": stored,
             "timestamp": datetime.now().isoformat()
         }
         
-        if data.get('action') in ['reading_session', 'page_session']:
-            content_analysis = analyzer.analyze_content(data)
-            behavior_analysis = analyzer.analyze_reading_behavior(data)
+        if analysis_slot is not None:
+            with analysis_slot:
+                content_analysis = analyzer.analyze_content(data)
+                behavior_analysis = analyzer.analyze_reading_behavior(data)
             
             logger.info(f"Content analysis result: {content_analysis}")
             logger.info(f"Behavior analysis result: {behavior_analysis}")
@@ -396,9 +668,18 @@ def analyze_interaction():
                 "content_analysis": content_analysis,
                 "behavior_analysis": behavior_analysis
             })
+        elif analyzable:
+            result["analysis_deferred"] = True
         
         return jsonify(result)
         
+    except PayloadError as e:
+        return jsonify({"error": str(e)}), 400
+        
+    except IngestLogError as e:
+        logger.error(f"Ingest log error: {str(e)}")
+        return jsonify({"error": str(e)}), 503
+        
     except Exception as e:
         logger.error(f"Analysis error: {str(e)}")
         return jsonify({"error": str(e)}), 500
@@ -407,33 +688,35 @@ def analyze_interaction():
 def store_interaction():
     """Store user interaction data for analysis"""
     try:
-        data = request.get_json()
+        try:
+            data, _ = decode_request_payload()
+        except PayloadError as e:
+            return jsonify({"error": str(e)}), 400
         
-        if not data:
+        if not isinstance(data, dict) or not data:
             return jsonify({"error": "No data provided"}), 400
         
-        conn = sqlite3.connect(analyzer.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            INSERT INTO interactions 
-            (session_id, action_type, url, title, content_summary, interaction_data, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (
+        row_id = analyzer.write_interaction((
             data.get('session_id'),
             data.get('action_type'),
             data.get('url'),
             data.get('title'),
-            data.get('content_summary'),
-            data.get('interaction_data'),
-            data.get('timestamp')
+            as_json_text(data.get('content_summary')),
+            as_json_text(data.get('interaction_data')),
+            data.get('timestamp'),
+            False,
+            False
         ))
         
-        conn.commit()
-        conn.close()
-        
         logger.info(f"Stored interaction: {data.get('action_type')} on {data.get('url')}")
-        return jsonify({"success": True, "id": cursor.lastrowid})
+        return jsonify({"success": True, "id": row_id})
+        
+    except PayloadError as e:
+        return jsonify({"error": str(e)}), 400
+        
+    except IngestLogError as e:
+        logger.error(f"Ingest log error: {str(e)}")
+        return jsonify({"error": str(e)}), 503
         
     except Exception as e:
         logger.error(f"Error storing interaction: {str(e)}")
@@ -453,7 +736,7 @@ def get_analytics():
         if total_interactions == 0:
             # Return sample data if no interactions exist
             conn.close()
-            return jsonify({
+            return compressed_jsonify({
                 "readingPatterns": {
                     "totalSessions": 5,
                     "avgSessionTime": 12.3,
@@ -612,12 +895,12 @@ def get_analytics():
             "generatedAt": datetime.now().isoformat()
         }
         
-        return jsonify(analytics)
+        return compressed_jsonify(analytics)
         
     except Exception as e:
         logger.error(f"Analytics error: {str(e)}")
         # Return fallback data on error
-        return jsonify({
+        return compressed_jsonify({
             "readingPatterns": {
                 "totalSessions": 0,
                 "avgSessionTime": 0,
@@ -653,7 +936,7 @@ def get_analytics():
             },
             "generatedAt": datetime.now().isoformat(),
             "error": str(e)
-        }), 200
+        })
 
 @app.route('/api/insights', methods=['GET'])
 def get_insights():
@@ -707,10 +990,78 @@ def get_insights():
         logger.error(f"Insights error: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@app.route('/api/related', methods=['GET'])
+def get_related():
+    """Get previously analyzed pages similar to the given url"""
+    try:
+        url = request.args.get('url', '')
+        if not url:
+            return jsonify({"error": "url parameter is required"}), 400
+        
+        limit = min(max(request.args.get('limit', 10, type=int), 1), RELATED_MAX_RESULTS)
+        
+        started = time.perf_counter()
+        related = analyzer.related_index.related(url, limit)
+        took_ms = (time.perf_counter() - started) * 1000
+        
+        if related is None:
+            return jsonify({"error": "Page has not been analyzed", "url": url}), 404
+        
+        return jsonify({
+            "url": url,
+            "related": related,
+            "indexed_pages": len(analyzer.related_index),
+            "took_ms": round(took_ms, 2)
+        })
+        
+    except Exception as e:
+        logger.error(f"Related pages error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/admission', methods=['GET'])
+def get_admission_stats():
+    """Get load-shedding counters and pending analysis backlog"""
+    try:
+        stats = admission.stats()
+        stats["pending_analysis"] = analyzer.count_pending_interactions()
+        if analyzer.ingest_log is not None:
+            stats["ingest_log"] = {
+                **analyzer.ingest_log.stats,
+                "pending_segments": analyzer.ingest_log.pending_segments()
+            }
+        return jsonify(stats)
+        
+    except Exception as e:
+        logger.error(f"Admission stats error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/process-pending', methods=['POST'])
+def process_pending():
+    """Analyze interactions that were stored without analysis"""
+    try:
+        # Batch work is bounded by limit and the analysis slots, not the per-client rate
+        analysis_slot = admission.try_analysis(None)
+        if analysis_slot is None:
+            return too_many_requests("Analysis capacity is busy, retry later")
+        
+        limit = min(max(request.args.get('limit', PENDING_BATCH_SIZE, type=int), 1), PENDING_BATCH_SIZE)
+        with analysis_slot:
+            processed = analyzer.process_pending_interactions(limit)
+        
+        return jsonify({"processed": processed, "timestamp": datetime.now().isoformat()})
+        
+    except Exception as e:
+        logger.error(f"Pending analysis error: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 @app.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({"status": "healthy", "timestamp": datetime.now().isoformat()})
+    return jsonify({
+        "status": "healthy",
+        "admission": admission.stats(),
+        "timestamp": datetime.now().isoformat()
+    })
 
 if __name__ == '__main__':
     # Install required packages if not available
@@ -722,4 +1073,8 @@ if __name__ == '__main__':
         import subprocess
         subprocess.check_call(['pip', 'install', 'nltk', 'textblob', 'flask', 'flask-cors'])
     
+    # Replay the ingest log at startup; skip the reloader's watcher process
+    if DURABLE_INGEST and os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        analyzer.start_ingest_log()
+    
     app.run(debug=True, host='0.0.0.0', port=5000)
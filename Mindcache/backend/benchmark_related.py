@@ -0,0 +1,117 @@
+"""Latency benchmark for the related-pages index.
+
+Builds a synthetic corpus in a temporary directory and reports index load
+time, first-query latency and steady-state query latency for brute-force
+search and, optionally, IVF training time and latency for the coarse index.
+
+Usage:
+    python benchmark_related.py --pages 100000 --queries 200 --ivf
+"""
+import argparse
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+from related_index import RelatedPagesIndex, VECTOR_DIM
+
+# Latency targets (p95, milliseconds)
+BRUTE_FORCE_TARGET_MS = 50.0  # up to 100k pages
+IVF_TARGET_MS = 10.0
+
+
+def build_corpus(index: RelatedPagesIndex, n_pages: int, seed: int = 0):
+    """Append synthetic topic-clustered pages to index"""
+    rng = np.random.default_rng(seed)
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    vocabulary = ["".join(letters[rng.integers(0, 26, size=7)]) for _ in range(20000)]
+    n_topics = 200
+    topic_terms = rng.integers(0, len(vocabulary), size=(n_topics, 40))
+
+    for page in range(n_pages):
+        topic = topic_terms[page % n_topics]
+        words = rng.choice(topic, size=60).tolist() + rng.integers(0, len(vocabulary), size=40).tolist()
+        text = " ".join(vocabulary[w] for w in words)
+        index.add(f"https://example.com/page/{page}", f"Page {page}", text)
+
+
+def measure(index: RelatedPagesIndex, n_queries: int, k: int = 10) -> dict:
+    """Time queries on a freshly opened index; the first one is reported separately"""
+    rng = np.random.default_rng(1)
+    urls = [index.rows[i]['url'] for i in rng.integers(0, len(index), size=n_queries + 1)]
+
+    started = time.perf_counter()
+    index.related(urls.pop(), k)
+    first_ms = (time.perf_counter() - started) * 1000
+
+    timings = []
+    for url in urls:
+        started = time.perf_counter()
+        index.related(url, k)
+        timings.append((time.perf_counter() - started) * 1000)
+
+    timings = np.array(timings)
+    return {
+        'first_ms': first_ms,
+        'p50_ms': float(np.percentile(timings, 50)),
+        'p95_ms': float(np.percentile(timings, 95)),
+        'max_ms': float(timings.max()),
+    }
+
+
+def recall_at_k(index: RelatedPagesIndex, exact: RelatedPagesIndex, n_queries: int, k: int = 10) -> float:
+    rng = np.random.default_rng(2)
+    hits = total = 0
+    for i in rng.integers(0, len(index), size=n_queries):
+        url = index.rows[i]['url']
+        truth = {r['url'] for r in exact.related(url, k)}
+        found = {r['url'] for r in index.related(url, k)}
+        hits += len(truth & found)
+        total += len(truth)
+    return hits / max(total, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', type=int, default=20000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--ivf', action='store_true', help='also benchmark the IVF coarse index')
+    args = parser.parse_args()
+
+    index_dir = tempfile.mkdtemp(prefix='mindcache-related-')
+    try:
+        started = time.perf_counter()
+        exact = RelatedPagesIndex(index_dir, dim=VECTOR_DIM)
+        build_corpus(exact, args.pages)
+        build_s = time.perf_counter() - started
+        print(f"Indexed {args.pages} pages in {build_s:.1f}s ({args.pages / build_s:.0f} pages/s)")
+
+        started = time.perf_counter()
+        exact = RelatedPagesIndex(index_dir, dim=VECTOR_DIM)
+        print(f"Opened index in {(time.perf_counter() - started) * 1000:.0f}ms")
+
+        stats = measure(exact, args.queries)
+        status = "OK" if stats['p95_ms'] <= BRUTE_FORCE_TARGET_MS else "OVER TARGET"
+        print(f"brute force: first {stats['first_ms']:.2f}ms  p50 {stats['p50_ms']:.2f}ms  "
+              f"p95 {stats['p95_ms']:.2f}ms  max {stats['max_ms']:.2f}ms  "
+              f"(target p95 <= {BRUTE_FORCE_TARGET_MS}ms) {status}")
+
+        if args.ivf:
+            # Trained explicitly here; the server trains in a background thread
+            # and serves brute-force results until training finishes
+            ivf = RelatedPagesIndex(index_dir, dim=VECTOR_DIM, use_ivf=True, ivf_min_rows=0)
+            started = time.perf_counter()
+            ivf.build_coarse_index()
+            print(f"ivf training: {time.perf_counter() - started:.2f}s")
+            stats = measure(ivf, args.queries)
+            recall = recall_at_k(ivf, exact, min(args.queries, 100))
+            status = "OK" if stats['p95_ms'] <= IVF_TARGET_MS else "OVER TARGET"
+            print(f"ivf (nprobe={ivf.nprobe}): first {stats['first_ms']:.2f}ms  p50 {stats['p50_ms']:.2f}ms  p95 {stats['p95_ms']:.2f}ms  "
+                  f"max {stats['max_ms']:.2f}ms  recall@10 {recall:.2f}  (target p95 <= {IVF_TARGET_MS}ms) {status}")
+    finally:
+        shutil.rmtree(index_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
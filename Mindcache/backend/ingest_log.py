@@ -0,0 +1,415 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Log configuration
+GROUP_COMMIT_INTERVAL = 0.005  # seconds between fsyncs
+SEGMENT_MAX_BYTES = 4 * 1024 * 1024
+SEGMENT_MAX_AGE = 1.0  # seconds before a non-empty segment is sealed
+LOADER_INTERVAL = 0.5  # seconds between loader passes
+APPEND_TIMEOUT = 5.0  # seconds to wait for a group commit
+
+SEGMENT_SUFFIX = ".log"
+VALID_LENGTH_SUFFIX = ".valid"  # sidecar holding the loadable length of a segment
+DEAD_LETTER_FILE = "dead_letter.jsonl"
+
+# Errors caused by a record's contents; anything else (e.g. a locked or full
+# database) leaves the segment in place for the next loader pass
+RECORD_ERRORS = (sqlite3.IntegrityError, sqlite3.ProgrammingError, sqlite3.InterfaceError,
+                 sqlite3.DataError, ValueError, TypeError, OverflowError)
+# OperationalErrors that come from the database rather than the record
+TRANSIENT_ERROR_MESSAGES = ('locked', 'busy', 'full', 'disk i/o', 'readonly', 'unable to open',
+                            'interrupted')
+
+
+def is_record_error(error: Exception) -> bool:
+    """True if error was caused by the record being applied, not the database.
+
+    SQL functions such as json_extract() raise OperationalError for bad input
+    ("malformed JSON"), so only busy/locked/full/I/O errors count as transient.
+    """
+    if isinstance(error, sqlite3.OperationalError):
+        message = str(error).lower()
+        return not any(text in message for text in TRANSIENT_ERROR_MESSAGES)
+    return isinstance(error, RECORD_ERRORS)
+
+
+class IngestLogError(RuntimeError):
+    """Raised when a record could not be made durable"""
+
+
+class IngestLog:
+    """Append-only segment log for ingest with group commit.
+
+    append() buffers a JSON record and blocks until a flusher thread has
+    written and fsynced it together with every other record that arrived in
+    the same GROUP_COMMIT_INTERVAL. Segments are sealed by size or age and a
+    loader thread applies each sealed segment to SQLite in one transaction via
+    apply_batch(cursor, records). The segment name is recorded in
+    ingest_log_applied inside that transaction, so replay after a crash never
+    applies a segment twice. If the batch insert fails, the segment's records
+    are applied one at a time and any that still fail are moved to
+    DEAD_LETTER_FILE, so one bad record cannot block the loader. Segments
+    left over from a previous run are replayed by start().
+    """
+
+    def __init__(self, log_dir: str, db_path: str,
+                 apply_batch: Callable[[sqlite3.Cursor, List], None],
+                 group_commit_interval: float = GROUP_COMMIT_INTERVAL,
+                 segment_max_bytes: int = SEGMENT_MAX_BYTES,
+                 segment_max_age: float = SEGMENT_MAX_AGE,
+                 loader_interval: float = LOADER_INTERVAL):
+        self.log_dir = log_dir
+        self.db_path = db_path
+        self.apply_batch = apply_batch
+        self.group_commit_interval = group_commit_interval
+        self.segment_max_bytes = segment_max_bytes
+        self.segment_max_age = segment_max_age
+        self.loader_interval = loader_interval
+
+        self._cond = threading.Condition()
+        self._buffer: List[bytes] = []
+        self._appended_seq = 0
+        self._durable_seq = 0
+        self._failed_seq = 0
+        self._closed = False
+
+        self._segment_file = None
+        self._segment_name: Optional[str] = None
+        self._segment_bytes = 0
+        self._segment_opened = 0.0
+        self._next_segment = 0
+        # Acknowledged length of segments whose failed write could not be truncated,
+        # also persisted next to the segment for replay after a restart
+        self._valid_bytes: Dict[str, int] = {}
+        self._sealed: List[str] = []
+        self._loader_lock = threading.Lock()
+        self._loader_wakeup = threading.Event()
+
+        self.stats = {'appended': 0, 'group_commits': 0, 'segments_applied': 0, 'records_applied': 0,
+                      'records_dead_lettered': 0}
+        self._threads: List[threading.Thread] = []
+
+        os.makedirs(log_dir, exist_ok=True)
+        self._init_table()
+
+    def _init_table(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS ingest_log_applied (
+                segment TEXT PRIMARY KEY,
+                applied_at DATETIME
+            )
+        ''')
+        conn.commit()
+        conn.close()
+
+    def _fsync_dir(self):
+        """Make file creation and removal in log_dir durable"""
+        if os.name == 'nt':
+            # Directories cannot be opened for fsync on Windows; NTFS journals metadata
+            return
+        fd = os.open(self.log_dir, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _existing_segments(self) -> List[str]:
+        return sorted(name for name in os.listdir(self.log_dir) if name.endswith(SEGMENT_SUFFIX))
+
+    def _clear_orphan_markers(self, segments: List[str]):
+        """Forget markers for segments already deleted so their names can be reused"""
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT segment FROM ingest_log_applied')
+        orphans = [(row[0],) for row in cursor.fetchall() if row[0] not in segments]
+        cursor.executemany('DELETE FROM ingest_log_applied WHERE segment = ?', orphans)
+        conn.commit()
+        conn.close()
+
+    def start(self):
+        """Replay segments from a previous run, then start background threads"""
+        leftover = self._existing_segments()
+        self._clear_orphan_markers(leftover)
+        if leftover:
+            self._next_segment = int(leftover[-1][:-len(SEGMENT_SUFFIX)]) + 1
+            logger.info(f"Replaying {len(leftover)} ingest log segment(s)")
+            self._sealed.extend(leftover)
+            try:
+                self.apply_sealed()
+            except Exception as e:
+                # Keep accepting writes; the loader retries the remaining segments
+                logger.error(f"Ingest log replay error: {str(e)}")
+
+        for target, name in ((self._flush_loop, 'ingest-log-flusher'), (self._load_loop, 'ingest-log-loader')):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def append(self, record) -> None:
+        """Durably log record; returns once it has been fsynced.
+
+        Raises ValueError for records containing NaN or Infinity, which
+        SQLite's JSON functions would reject at load time.
+        """
+        line = (json.dumps(record, separators=(',', ':'), allow_nan=False) + "\n").encode('utf-8')
+        with self._cond:
+            if self._closed:
+                raise IngestLogError("Ingest log is closed")
+            self._buffer.append(line)
+            self._appended_seq += 1
+            seq = self._appended_seq
+            deadline = time.monotonic() + APPEND_TIMEOUT
+            while self._durable_seq < seq and self._failed_seq < seq:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise IngestLogError("Timed out waiting for group commit")
+                self._cond.wait(remaining)
+            if self._durable_seq < seq:
+                raise IngestLogError("Group commit failed")
+            self.stats['appended'] += 1
+
+    def _open_segment(self):
+        self._segment_name = f"{self._next_segment:012d}{SEGMENT_SUFFIX}"
+        self._next_segment += 1
+        # Unbuffered, so a failed write leaves nothing queued to be flushed on close
+        self._segment_file = open(os.path.join(self.log_dir, self._segment_name), 'ab', buffering=0)
+        self._fsync_dir()
+        self._segment_bytes = 0
+        self._segment_opened = time.monotonic()
+
+    def _seal_segment(self):
+        """Close the active segment and hand it to the loader"""
+        if self._segment_file is None:
+            return
+        self._segment_file.close()
+        self._sealed.append(self._segment_name)
+        self._segment_file = None
+        self._segment_name = None
+        self._loader_wakeup.set()
+
+    def _flush_once(self):
+        with self._cond:
+            lines = self._buffer
+            self._buffer = []
+            target_seq = self._appended_seq
+
+        if lines:
+            try:
+                if self._segment_file is None:
+                    self._open_segment()
+                data = memoryview(b"".join(lines))
+                while data:
+                    data = data[self._segment_file.write(data):]
+                os.fsync(self._segment_file.fileno())
+                self._segment_bytes += sum(len(line) for line in lines)
+                with self._cond:
+                    self._durable_seq = target_seq
+                    self.stats['group_commits'] += 1
+                    self._cond.notify_all()
+            except OSError as e:
+                logger.error(f"Ingest log write error: {str(e)}")
+                with self._cond:
+                    self._failed_seq = target_seq
+                    self._cond.notify_all()
+                self._discard_failed_write()
+                return
+
+        if self._segment_file is not None and (
+                self._segment_bytes >= self.segment_max_bytes or
+                time.monotonic() - self._segment_opened >= self.segment_max_age):
+            with self._loader_lock:
+                self._seal_segment()
+
+    def _discard_failed_write(self):
+        """Cut rejected records off the active segment and seal it.
+
+        Callers were told the write failed and may retry, so those bytes
+        must never be loaded. If truncation also fails, the last acknowledged
+        length is written to a sidecar file and the segment is only read up
+        to it, including on replay after a restart.
+        """
+        if self._segment_file is None:
+            return
+        try:
+            self._segment_file.truncate(self._segment_bytes)
+            os.fsync(self._segment_file.fileno())
+        except OSError as e:
+            logger.error(f"Ingest log truncate error: {str(e)}")
+            self._valid_bytes[self._segment_name] = self._segment_bytes
+            self._write_valid_length(self._segment_name, self._segment_bytes)
+        with self._loader_lock:
+            self._seal_segment()
+
+    def _valid_length_path(self, name: str) -> str:
+        return os.path.join(self.log_dir, name + VALID_LENGTH_SUFFIX)
+
+    def _write_valid_length(self, name: str, length: int):
+        try:
+            with open(self._valid_length_path(name), 'w') as f:
+                f.write(str(length))
+                f.flush()
+                os.fsync(f.fileno())
+            self._fsync_dir()
+        except OSError as e:
+            # Still honored in memory until this process exits
+            logger.error(f"Could not persist valid length of {name}: {str(e)}")
+
+    def _read_valid_length(self, name: str) -> Optional[int]:
+        if name in self._valid_bytes:
+            return self._valid_bytes[name]
+        try:
+            with open(self._valid_length_path(name)) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                if self._closed and not self._buffer:
+                    break
+            self._flush_once()
+            time.sleep(self.group_commit_interval)
+
+    def _load_loop(self):
+        while not self._closed:
+            self._loader_wakeup.wait(self.loader_interval)
+            self._loader_wakeup.clear()
+            try:
+                self.apply_sealed()
+            except Exception as e:
+                logger.error(f"Ingest log loader error: {str(e)}")
+
+    def _read_segment(self, name: str) -> List:
+        records = []
+        valid_bytes = self._read_valid_length(name)
+        with open(os.path.join(self.log_dir, name), 'rb') as f:
+            data = f.read() if valid_bytes is None else f.read(valid_bytes)
+            for line in data.splitlines():
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    # Torn tail from a crash mid-write; the record was never acknowledged
+                    logger.warning(f"Skipping unreadable record in {name}")
+        return records
+
+    def _apply_records(self, conn: sqlite3.Connection, name: str, records: List) -> int:
+        """Apply records in one batch, falling back to one at a time on error.
+
+        Returns the number of records applied. Records that fail on their own
+        are appended to DEAD_LETTER_FILE and logged.
+        """
+        cursor = conn.cursor()
+        # Explicit BEGIN so releasing the savepoint does not commit before the
+        # segment is marked applied
+        if not conn.in_transaction:
+            cursor.execute('BEGIN')
+        cursor.execute('SAVEPOINT segment_batch')
+        try:
+            self.apply_batch(cursor, records)
+            cursor.execute('RELEASE segment_batch')
+            return len(records)
+        except (sqlite3.Error, *RECORD_ERRORS) as e:
+            if not is_record_error(e):
+                raise
+            logger.error(f"Ingest log segment {name} failed as a batch ({str(e)}); applying records singly")
+            cursor.execute('ROLLBACK TO segment_batch')
+            cursor.execute('RELEASE segment_batch')
+
+        applied = 0
+        rejected = []
+        for record in records:
+            try:
+                self.apply_batch(cursor, [record])
+                applied += 1
+            except (sqlite3.Error, *RECORD_ERRORS) as e:
+                if not is_record_error(e):
+                    raise
+                rejected.append({'segment': name, 'error': str(e), 'record': record})
+
+        if rejected:
+            self._dead_letter(rejected)
+        return applied
+
+    def _dead_letter(self, entries: List[Dict]):
+        path = os.path.join(self.log_dir, DEAD_LETTER_FILE)
+        created = not os.path.exists(path)
+        with open(path, 'ab') as f:
+            for entry in entries:
+                f.write((json.dumps(entry) + "\n").encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        if created:
+            self._fsync_dir()
+        self.stats['records_dead_lettered'] += len(entries)
+        logger.error(f"Moved {len(entries)} unloadable ingest record(s) from segment "
+                     f"{entries[0]['segment']} to {path}")
+
+    def apply_sealed(self) -> int:
+        """Apply every sealed segment to the database, oldest first"""
+        with self._loader_lock:
+            segments = list(self._sealed)
+
+        applied = 0
+        for name in segments:
+            path = os.path.join(self.log_dir, name)
+            conn = sqlite3.connect(self.db_path)
+            try:
+                cursor = conn.cursor()
+                cursor.execute('SELECT 1 FROM ingest_log_applied WHERE segment = ?', (name,))
+                if cursor.fetchone() is None:
+                    records = self._read_segment(name)
+                    records_applied = self._apply_records(conn, name, records) if records else 0
+                    cursor.execute('INSERT INTO ingest_log_applied (segment, applied_at) VALUES (?, ?)',
+                                   (name, datetime.now()))
+                    conn.commit()
+                    self.stats['records_applied'] += records_applied
+                # Sidecar first: a stale one must not outlive its segment and
+                # cut short a later segment reusing the name
+                if os.path.exists(self._valid_length_path(name)):
+                    os.remove(self._valid_length_path(name))
+                os.remove(path)
+                self._fsync_dir()
+                conn.execute('DELETE FROM ingest_log_applied WHERE segment = ?', (name,))
+                conn.commit()
+            finally:
+                conn.close()
+
+            with self._loader_lock:
+                self._sealed.remove(name)
+                self._valid_bytes.pop(name, None)
+            self.stats['segments_applied'] += 1
+            applied += 1
+        return applied
+
+    def pending_segments(self) -> int:
+        with self._loader_lock:
+            return len(self._sealed) + (1 if self._segment_file is not None else 0)
+
+    def close(self):
+        """Flush buffered records, seal the active segment and apply everything"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+        self._loader_wakeup.set()
+        for thread in self._threads:
+            thread.join()
+        self._flush_once()
+        with self._loader_lock:
+            self._seal_segment()
+        try:
+            self.apply_sealed()
+        except Exception as e:
+            # Segments stay on disk and are replayed on the next start
+            logger.error(f"Ingest log close error: {str(e)}")
+
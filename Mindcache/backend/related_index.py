@@ -0,0 +1,425 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from collections import Counter
+from typing import Dict, List, Optional
+
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Index configuration
+VECTOR_DIM = 1024  # hashed feature buckets per page
+SEARCH_BLOCK_ROWS = 65536  # rows scored per matrix-vector product
+NORM_BLOCK_ROWS = 8192  # rows per block when recomputing weighted norms
+REWEIGHT_GROWTH = 0.1  # corpus growth that triggers fresh IDF weights
+IVF_MIN_ROWS = 20000  # corpus size before the coarse index is trained
+IVF_NPROBE = 8  # coarse lists scanned per query
+IVF_MAX_TAIL_ROWS = 2048  # rows added since training that are scanned exactly
+
+TOKEN_PATTERN = re.compile(r'\b[a-z]{3,}\b')
+STOP_WORDS = {
+    'the', 'and', 'for', 'are', 'but', 'not', 'you', 'all', 'any', 'can', 'had',
+    'her', 'was', 'one', 'our', 'out', 'has', 'his', 'how', 'its', 'may', 'new',
+    'now', 'see', 'who', 'did', 'get', 'use', 'that', 'this', 'with', 'from',
+    'they', 'been', 'have', 'were', 'said', 'each', 'which', 'their', 'will',
+    'about', 'would', 'there', 'could', 'other', 'after', 'into', 'than', 'then',
+    'them', 'these', 'some', 'what', 'when', 'your', 'more', 'also', 'just',
+}
+
+
+class HashedTermVectorizer:
+    """Stateless feature hashing of page text into a fixed-size TF vector"""
+
+    def __init__(self, dim: int = VECTOR_DIM):
+        self.dim = dim
+
+    def term_frequencies(self, text: str) -> np.ndarray:
+        """Return signed, sublinear term frequencies per hash bucket"""
+        vector = np.zeros(self.dim, dtype=np.float32)
+        tokens = [t for t in TOKEN_PATTERN.findall(text.lower()) if t not in STOP_WORDS]
+        if not tokens:
+            return vector
+
+        for token, count in Counter(tokens).items():
+            h = zlib.crc32(token.encode('utf-8'))
+            # High bit picks the sign so bucket collisions tend to cancel out
+            sign = -1.0 if h & 0x80000000 else 1.0
+            vector[h % self.dim] += sign * (1.0 + np.log(count))
+        return vector
+
+    def transform(self, text: str) -> np.ndarray:
+        """Return the L2-normalized TF vector for text"""
+        vector = self.term_frequencies(text)
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector
+
+
+def weighted_norms(matrix: np.ndarray, start: int, stop: int, weights: np.ndarray) -> np.ndarray:
+    """Return sqrt(sum(row**2 * weights)) for rows [start, stop) of matrix"""
+    norms = np.empty(stop - start, dtype=np.float32)
+    for block_start in range(start, stop, NORM_BLOCK_ROWS):
+        block_stop = min(block_start + NORM_BLOCK_ROWS, stop)
+        block = np.asarray(matrix[block_start:block_stop])
+        norms[block_start - start:block_stop - start] = np.sqrt((block * block) @ weights)
+    return norms
+
+
+class IVFCoarseIndex:
+    """Inverted-file coarse quantizer: k-means centroids plus per-list row ids.
+
+    Rows are projected into TF-IDF space with the idf given at training time,
+    so the quantizer stays usable as IDF drifts; exact scores are computed
+    by the caller with current weights.
+    """
+
+    def __init__(self, centroids: np.ndarray, idf: np.ndarray):
+        self.centroids = centroids
+        self.idf = idf
+        self.lists: List[List[np.ndarray]] = [[] for _ in range(len(centroids))]
+        self.trained_rows = 0
+
+    def project(self, vectors: np.ndarray) -> np.ndarray:
+        weighted = vectors * self.idf
+        norms = np.linalg.norm(weighted, axis=-1, keepdims=True)
+        return weighted / np.maximum(norms, 1e-12)
+
+    @classmethod
+    def train(cls, matrix: np.ndarray, n_rows: int, n_lists: int, idf: np.ndarray,
+              iterations: int = 10, sample_size: int = 50000, seed: int = 0) -> 'IVFCoarseIndex':
+        """Run spherical k-means on a sample of the first n_rows and assign them"""
+        rng = np.random.default_rng(seed)
+        sample_idx = rng.choice(n_rows, size=min(sample_size, n_rows), replace=False)
+        index = cls(np.empty((0, matrix.shape[1]), dtype=np.float32), idf)
+        sample = index.project(np.asarray(matrix[np.sort(sample_idx)]))
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(n_lists):
+                members = sample[assignment == c]
+                if len(members) == 0:
+                    continue
+                centroid = members.sum(axis=0)
+                norm = np.linalg.norm(centroid)
+                if norm > 0:
+                    centroids[c] = centroid / norm
+
+        index.centroids = centroids.astype(np.float32)
+        index.lists = [[] for _ in range(n_lists)]
+        index.assign(matrix, 0, n_rows)
+        return index
+
+    def assign(self, matrix: np.ndarray, start: int, stop: int):
+        """Add rows [start, stop) of matrix to their nearest coarse list"""
+        for block_start in range(start, stop, SEARCH_BLOCK_ROWS):
+            block_stop = min(block_start + SEARCH_BLOCK_ROWS, stop)
+            block = self.project(np.asarray(matrix[block_start:block_stop]))
+            nearest = np.argmax(block @ self.centroids.T, axis=1)
+            order = np.argsort(nearest, kind='stable')
+            boundaries = np.cumsum(np.bincount(nearest, minlength=len(self.centroids)))[:-1]
+            for c, members in enumerate(np.split(order + block_start, boundaries)):
+                if len(members):
+                    self.lists[c].append(members.astype(np.int64))
+        # Published last so concurrent readers never see unassigned rows as covered
+        self.trained_rows = max(self.trained_rows, stop)
+
+    def candidates(self, query: np.ndarray, nprobe: int) -> np.ndarray:
+        """Return row ids from the nprobe lists closest to query"""
+        nprobe = min(nprobe, len(self.centroids))
+        closest = np.argpartition(-(self.centroids @ self.project(query)), nprobe - 1)[:nprobe]
+        rows = [chunk for c in closest for chunk in list(self.lists[c])]
+        return np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+
+
+class RelatedPagesIndex:
+    """Disk-backed store of page vectors with nearest-neighbour search.
+
+    Rows are L2-normalized hashed TF vectors in a flat float32 file that is
+    memory-mapped for search and appended to as pages are analyzed.
+    Re-analyzing a known page overwrites its row in place. Document
+    frequencies are rebuilt from the matrix on load and kept in memory; the
+    current IDF is applied at query time, with per-row weighted norms cached
+    until the corpus grows by REWEIGHT_GROWTH. Row metadata is an append-only
+    JSONL file written only for new rows and title changes.
+    """
+
+    def __init__(self, index_dir: str = "related_index", dim: int = VECTOR_DIM,
+                 use_ivf: bool = False, ivf_min_rows: int = IVF_MIN_ROWS,
+                 nprobe: int = IVF_NPROBE):
+        self.index_dir = index_dir
+        self.dim = dim
+        self.use_ivf = use_ivf
+        self.ivf_min_rows = ivf_min_rows
+        self.nprobe = nprobe
+        self.vectorizer = HashedTermVectorizer(dim)
+
+        self.vectors_path = os.path.join(index_dir, "vectors.f32")
+        self.meta_path = os.path.join(index_dir, "rows.jsonl")
+
+        self._lock = threading.RLock()
+        self._matrix = None
+        self._weights = None
+        self._weights_doc_count = 0
+        self._norms = np.empty(0, dtype=np.float32)
+        self._ivf = None
+        self._ivf_job = None
+        self.rows: List[Dict] = []
+        self.row_by_key: Dict[str, int] = {}
+        self.doc_freq = np.zeros(dim, dtype=np.int64)
+
+        os.makedirs(index_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        """Read metadata, drop vectors written without metadata, rebuild doc frequencies"""
+        needs_rewrite = False
+        meta_lines = 0
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Torn final line from an interrupted write
+                        needs_rewrite = True
+                        break
+                    meta_lines += 1
+                    row = entry['row']
+                    if row == len(self.rows):
+                        self.rows.append(entry)
+                    elif row < len(self.rows):
+                        self.rows[row] = entry
+                    self.row_by_key[entry['key']] = row
+
+        row_bytes = self.dim * 4
+        file_size = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+        stored_rows = file_size // row_bytes
+        if stored_rows < len(self.rows):
+            logger.warning(f"Related index has {len(self.rows)} rows but only {stored_rows} vectors; truncating metadata")
+            self.rows = self.rows[:stored_rows]
+            self.row_by_key = {k: r for k, r in self.row_by_key.items() if r < stored_rows}
+            needs_rewrite = True
+        # Title changes add lines; compact once they outnumber the rows
+        if needs_rewrite or meta_lines > 2 * len(self.rows):
+            self._rewrite_meta()
+        if file_size != len(self.rows) * row_bytes:
+            # Drop vectors appended without metadata and any torn final row
+            with open(self.vectors_path, 'r+b') as f:
+                f.truncate(len(self.rows) * row_bytes)
+
+        matrix = self.matrix()
+        for start in range(0, len(self.rows), NORM_BLOCK_ROWS):
+            block = np.asarray(matrix[start:start + NORM_BLOCK_ROWS])
+            self.doc_freq += np.count_nonzero(block, axis=0)
+
+    def _rewrite_meta(self):
+        """Compact the metadata log to one line per row"""
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for entry in self.rows:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(tmp_path, self.meta_path)
+
+    @property
+    def doc_count(self) -> int:
+        return len(self.rows)
+
+    def _idf(self) -> np.ndarray:
+        return (np.log((1.0 + self.doc_count) / (1.0 + self.doc_freq)) + 1.0).astype(np.float32)
+
+    def matrix(self) -> np.ndarray:
+        """Return a read-only memory map over all stored vectors"""
+        with self._lock:
+            if self._matrix is None or self._matrix.shape[0] != len(self.rows):
+                if not self.rows:
+                    return np.empty((0, self.dim), dtype=np.float32)
+                self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r',
+                                         shape=(len(self.rows), self.dim))
+            return self._matrix
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    @staticmethod
+    def key_for(url: str) -> str:
+        return hashlib.md5(url.encode('utf-8')).hexdigest()
+
+    def add(self, url: str, title: str, text: str) -> Optional[int]:
+        """Index page text under url and return its row, or None if empty"""
+        vector = self.vectorizer.transform(text)
+        if not vector.any():
+            return None
+
+        key = self.key_for(url)
+        with self._lock:
+            existing = self.row_by_key.get(key)
+            if existing is not None:
+                row = existing
+                self.doc_freq -= np.asarray(self.matrix()[row]) != 0
+                with open(self.vectors_path, 'r+b') as f:
+                    f.seek(row * self.dim * 4)
+                    f.write(vector.tobytes())
+                # Drop the mapping so searches see the rewritten row
+                self._matrix = None
+                if self._weights is not None and row < len(self._norms):
+                    self._norms[row] = np.sqrt((vector * vector) @ self._weights)
+            else:
+                row = len(self.rows)
+                with open(self.vectors_path, 'ab') as f:
+                    f.write(vector.tobytes())
+            self.doc_freq += vector != 0
+
+            previous = self.rows[row] if existing is not None else None
+            if previous is None or previous['title'] != title or previous['url'] != url:
+                entry = {'row': row, 'key': key, 'url': url, 'title': title}
+                with open(self.meta_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(entry) + "\n")
+                if previous is None:
+                    self.rows.append(entry)
+                else:
+                    self.rows[row] = entry
+                self.row_by_key[key] = row
+            return row
+
+    def _current_weights(self, matrix: np.ndarray):
+        """Return (idf**2, weighted row norms) covering every row of matrix.
+
+        Must be called with the lock held. Weights are refreshed when the
+        corpus has grown by REWEIGHT_GROWTH since they were computed; rows
+        added in between get norms under the existing weights.
+        """
+        n_rows = matrix.shape[0]
+        if self._weights is None or self.doc_count > (1 + REWEIGHT_GROWTH) * self._weights_doc_count:
+            self._weights = self._idf() ** 2
+            self._weights_doc_count = self.doc_count
+            self._norms = weighted_norms(matrix, 0, n_rows, self._weights)
+        elif len(self._norms) < n_rows:
+            tail = weighted_norms(matrix, len(self._norms), n_rows, self._weights)
+            self._norms = np.concatenate((self._norms, tail))
+        return self._weights, self._norms
+
+    def _schedule_ivf(self, n_rows: int):
+        """Start background IVF training or assignment when due (lock held)"""
+        if not self.use_ivf or n_rows < self.ivf_min_rows:
+            return
+        if self._ivf_job is not None and self._ivf_job.is_alive():
+            return
+        ivf = self._ivf
+        if ivf is None or n_rows >= 2 * ivf.trained_rows:
+            target = self.build_coarse_index
+        elif n_rows - ivf.trained_rows >= IVF_MAX_TAIL_ROWS:
+            target = self._assign_tail
+        else:
+            return
+        self._ivf_job = threading.Thread(target=self._run_ivf_job, args=(target,),
+                                         name='related-ivf', daemon=True)
+        self._ivf_job.start()
+
+    def _run_ivf_job(self, target):
+        try:
+            target()
+        except Exception as e:
+            logger.error(f"Related index IVF error: {str(e)}")
+
+    def build_coarse_index(self) -> IVFCoarseIndex:
+        """Train the IVF coarse index over the current rows.
+
+        Runs without holding the index lock, so adds and brute-force searches
+        continue meanwhile; the new index is swapped in when ready.
+        """
+        with self._lock:
+            matrix = self.matrix()
+            idf = self._idf()
+        n_rows = matrix.shape[0]
+        n_lists = max(16, int(np.sqrt(n_rows)))
+        started = time.perf_counter()
+        ivf = IVFCoarseIndex.train(matrix, n_rows, n_lists, idf)
+        logger.info(f"Trained related-pages IVF index: {n_rows} rows, {n_lists} lists "
+                    f"in {time.perf_counter() - started:.1f}s")
+        with self._lock:
+            self._ivf = ivf
+        return ivf
+
+    def _assign_tail(self):
+        """Assign rows added since training to their coarse lists"""
+        with self._lock:
+            ivf = self._ivf
+            matrix = self.matrix()
+        if ivf is not None:
+            ivf.assign(matrix, ivf.trained_rows, matrix.shape[0])
+
+    def search(self, query: np.ndarray, k: int = 10, exclude_row: int = None) -> List[Dict]:
+        """Return the k rows most similar to a normalized TF query, with cosine scores"""
+        with self._lock:
+            matrix = self.matrix()
+            n_rows = matrix.shape[0]
+            if n_rows == 0 or k <= 0:
+                return []
+            weights, norms = self._current_weights(matrix)
+            self._schedule_ivf(n_rows)
+            ivf = self._ivf
+
+        query_norm = float(np.sqrt((query * query) @ weights))
+        if query_norm == 0:
+            return []
+        weighted_query = query * weights
+
+        if ivf is not None:
+            # Approximate over trained rows, exact over rows added since
+            covered = min(ivf.trained_rows, n_rows)
+            candidates = ivf.candidates(query, self.nprobe)
+            row_ids = np.concatenate((np.sort(candidates[candidates < covered]),
+                                      np.arange(covered, n_rows, dtype=np.int64)))
+            if len(row_ids):
+                scores = np.asarray(matrix[row_ids]) @ weighted_query
+            else:
+                scores = np.empty(0, dtype=np.float32)
+            scores /= np.maximum(norms[row_ids], 1e-12) * query_norm
+        else:
+            row_ids = None
+            scores = np.empty(n_rows, dtype=np.float32)
+            for start in range(0, n_rows, SEARCH_BLOCK_ROWS):
+                stop = min(start + SEARCH_BLOCK_ROWS, n_rows)
+                scores[start:stop] = matrix[start:stop] @ weighted_query
+            scores /= np.maximum(norms[:n_rows], 1e-12) * query_norm
+
+        if exclude_row is not None:
+            if row_ids is None:
+                scores[exclude_row] = -np.inf
+            else:
+                scores[row_ids == exclude_row] = -np.inf
+
+        k = min(k, len(scores))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+
+        results = []
+        for i in top:
+            if not np.isfinite(scores[i]) or scores[i] <= 0:
+                continue
+            row = int(row_ids[i]) if row_ids is not None else int(i)
+            entry = self.rows[row]
+            results.append({'url': entry['url'], 'title': entry['title'], 'score': round(float(scores[i]), 4)})
+        return results
+
+    def related(self, url: str, k: int = 10) -> Optional[List[Dict]]:
+        """Return pages similar to an indexed url, or None if url is unknown"""
+        row = self.row_by_key.get(self.key_for(url))
+        if row is None:
+            return None
+        query = np.array(self.matrix()[row])
+        return self.search(query, k, exclude_row=row)
+
+    def related_to_text(self, text: str, k: int = 10) -> List[Dict]:
+        """Return indexed pages similar to arbitrary text"""
+        return self.search(self.vectorizer.transform(text), k)
@@ -0,0 +1,149 @@
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import ingest_log
+from ingest_log import DEAD_LETTER_FILE, IngestLog, IngestLogError
+
+
+def apply_items(cursor, records):
+    # json_extract() raises OperationalError("malformed JSON") for bad payloads
+    cursor.executemany("INSERT INTO items (name, payload) VALUES (?, json_extract(?, '$'))", records)
+
+
+class IngestLogTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log_dir = os.path.join(self.tmp.name, 'log')
+        self.db_path = os.path.join(self.tmp.name, 'test.db')
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('CREATE TABLE items (name TEXT NOT NULL, payload TEXT)')
+        conn.commit()
+        conn.close()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def open_log(self) -> IngestLog:
+        # Long loader interval so only start() and close() apply segments
+        log = IngestLog(self.log_dir, self.db_path, apply_items, loader_interval=60)
+        log.start()
+        return log
+
+    def names(self):
+        conn = sqlite3.connect(self.db_path)
+        names = [row[0] for row in conn.execute('SELECT name FROM items ORDER BY rowid')]
+        conn.close()
+        return names
+
+    def write_segment(self, name, records):
+        os.makedirs(self.log_dir, exist_ok=True)
+        with open(os.path.join(self.log_dir, name), 'w') as f:
+            f.writelines(json.dumps(record) + "\n" for record in records)
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.log_dir) if name != DEAD_LETTER_FILE)
+
+    def test_close_applies_appended_records(self):
+        log = self.open_log()
+        for name in ('a', 'b', 'c'):
+            log.append([name, '{}'])
+        log.close()
+
+        self.assertEqual(self.names(), ['a', 'b', 'c'])
+        self.assertEqual(self.segments(), [])
+
+    def test_replay_skips_segment_already_applied(self):
+        # Crash after the loader committed 000 but before it removed the file
+        self.write_segment('000000000000.log', [['a', '{}']])
+        self.write_segment('000000000001.log', [['b', '{}']])
+        log = IngestLog(self.log_dir, self.db_path, apply_items)
+        conn = sqlite3.connect(self.db_path)
+        conn.execute("INSERT INTO items (name) VALUES ('a')")
+        conn.execute("INSERT INTO ingest_log_applied (segment) VALUES ('000000000000.log')")
+        conn.commit()
+        conn.close()
+
+        log.start()
+        log.close()
+        self.open_log().close()
+
+        self.assertEqual(self.names(), ['a', 'b'])
+        self.assertEqual(self.segments(), [])
+
+    def test_replay_honors_persisted_valid_length(self):
+        self.write_segment('000000000000.log', [['a', '{}'], ['rejected', '{}']])
+        with open(os.path.join(self.log_dir, '000000000000.log.valid'), 'w') as f:
+            f.write(str(len(json.dumps(['a', '{}'])) + 1))
+
+        self.open_log().close()
+
+        self.assertEqual(self.names(), ['a'])
+        self.assertEqual(self.segments(), [])
+
+    def test_failed_write_is_truncated(self):
+        log = self.open_log()
+        log.append(['a', '{}'])
+
+        real_fsync = os.fsync
+        failures = [OSError(5, 'Input/output error')]
+
+        def flaky_fsync(fd):
+            if failures:
+                raise failures.pop()
+            real_fsync(fd)
+
+        with mock.patch.object(ingest_log.os, 'fsync', flaky_fsync):
+            with self.assertRaises(IngestLogError):
+                log.append(['lost', '{}'])
+        log.append(['b', '{}'])
+        log.close()
+
+        self.assertEqual(self.names(), ['a', 'b'])
+
+    def test_bad_records_are_dead_lettered(self):
+        log = self.open_log()
+        log.append(['a', '{}'])
+        log.append(['nan', '{"x": NaN}'])
+        log.append([None, '{}'])
+        log.append(['b', '{}'])
+        log.close()
+
+        self.assertEqual(self.names(), ['a', 'b'])
+        self.assertEqual(self.segments(), [])
+        with open(os.path.join(self.log_dir, DEAD_LETTER_FILE)) as f:
+            dead = [json.loads(line) for line in f]
+        self.assertEqual([entry['record'][0] for entry in dead], ['nan', None])
+        self.assertEqual(log.stats['records_dead_lettered'], 2)
+
+    def test_locked_database_keeps_segment(self):
+        self.write_segment('000000000000.log', [['a', '{}']])
+        log = IngestLog(self.log_dir, self.db_path, apply_items)
+        log._sealed.append('000000000000.log')
+        blocker = sqlite3.connect(self.db_path)
+        blocker.execute('BEGIN EXCLUSIVE')
+        try:
+            with mock.patch.object(ingest_log.sqlite3, 'connect',
+                                   lambda path: sqlite3.Connection(path, timeout=0)):
+                with self.assertRaises(sqlite3.OperationalError):
+                    log.apply_sealed()
+        finally:
+            blocker.rollback()
+            blocker.close()
+
+        self.assertEqual(self.segments(), ['000000000000.log'])
+        log.apply_sealed()
+        self.assertEqual(self.names(), ['a'])
+
+    def test_append_rejects_non_finite_numbers(self):
+        log = self.open_log()
+        with self.assertRaises(ValueError):
+            log.append(['a', float('nan')])
+        log.close()
+
+
+if __name__ == '__main__':
+    unittest.main()